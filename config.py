@@ -9,3 +9,10 @@ TORCH_DTYPE = torch.bfloat16
 
 STEP_TIMEOUT = 5 * 60
 MAX_SESSIONS = 50  # Has effect only for API v1 (HTTP-based)
+
+# Concurrent stateless HTTP generate() requests with the same prompt length and parameters are merged into a batch.
+# generate() stops early only if all rows have emitted EOS, so a request with a short answer may wait
+# for the longest one in its batch (up to max_new_tokens). Keep these values small to limit this effect.
+BATCH_WAIT_TIME = 0.02  # Time to collect requests into a batch (in seconds)
+MAX_BATCH_SIZE = 4
+MAX_CACHED_PROMPT_LENGTH = 4096  # Longer HTTP generate() prompts are tokenized without caching (in characters)
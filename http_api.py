@@ -1,9 +1,16 @@
+import heapq
 import threading
+import time
+from collections import defaultdict
+from concurrent.futures import Future
 from contextlib import nullcontext
+from functools import lru_cache
+from queue import Empty, Queue
 from traceback import format_exc
 from uuid import uuid4
 
 import hivemind
+import torch
 from flask import jsonify, request
 
 import config
@@ -12,8 +19,51 @@ from app import app, models
 logger = hivemind.get_logger(__file__)
 
 
-storage_lock = threading.Lock()
-inference_sessions = hivemind.TimedStorage()  # Should be used under storage_lock
+class SessionStorage:
+    """A dict of expiring inference sessions. Expired entries are evicted lazily in O(log n) using a heap."""
+
+    def __init__(self):
+        self.lock = threading.RLock()  # Hold it to make a sequence of operations atomic
+        self._data = {}  # session_id -> (value, expiration_time)
+        self._expirations = []  # Heap of (expiration_time, session_id), may contain outdated entries
+
+    def store(self, session_id, value, expiration_time):
+        with self.lock:
+            self._data[session_id] = value, expiration_time
+            heapq.heappush(self._expirations, (expiration_time, session_id))
+            self._remove_expired()
+
+    def get(self, session_id):
+        with self.lock:
+            self._remove_expired()
+            return self._data[session_id][0]
+
+    def _remove_expired(self):
+        now = hivemind.get_dht_time()
+        while self._expirations and self._expirations[0][0] <= now:
+            expiration_time, session_id = heapq.heappop(self._expirations)
+            entry = self._data.get(session_id)
+            if entry is not None and entry[1] == expiration_time:  # Otherwise, the entry was refreshed or deleted
+                del self._data[session_id]
+
+    def __contains__(self, session_id):
+        with self.lock:
+            self._remove_expired()
+            return session_id in self._data
+
+    def __len__(self):
+        with self.lock:
+            self._remove_expired()
+            return len(self._data)
+
+    def __delitem__(self, session_id):
+        with self.lock:
+            del self._data[session_id]
+
+
+inference_sessions = SessionStorage()
+
+generate_queue = Queue()  # Stateless generate() requests waiting to be batched
 
 
 @app.get("/api/v1/open_inference_session")
@@ -24,7 +74,7 @@ def http_api_open_inference_session():
         logger.info(f"open_inference_session(), model={repr(model_name)}, max_length={max_length}")
 
         model, _ = models[model_name]
-        with storage_lock:
+        with inference_sessions.lock:
             if len(inference_sessions) >= config.MAX_SESSIONS:
                 raise RuntimeError(
                     f"Too many opened inference sessions (max {config.MAX_SESSIONS}), please come back later"
@@ -54,8 +104,7 @@ def http_api_close_inference_session():
         session_id = request.values.get("session_id")
         logger.info(f"close_inference_session(), session_id={repr(session_id)}")
 
-        with storage_lock:
-            del inference_sessions[session_id]
+        del inference_sessions[session_id]
 
         return jsonify(ok=True, session_id=session_id)
     except Exception:
@@ -76,39 +125,52 @@ def http_api_generate():
         session_id = request.values.get("session_id")
         logger.info(f"generate(), model={repr(model_name)}, session_id={repr(session_id)}, inputs={repr(inputs)}")
 
+        generate_kwargs = dict(
+            do_sample=do_sample,
+            temperature=temperature,
+            top_k=top_k,
+            top_p=top_p,
+            max_length=max_length,
+            max_new_tokens=max_new_tokens,
+        )
+
         model, tokenizer = models[model_name]
         if inputs is not None:
-            inputs = tokenizer(inputs, return_tensors="pt")["input_ids"].to(config.DEVICE)
+            input_ids = tokenize(model_name, inputs)
+            # Token IDs fit into int32, so we send half as many bytes to the device and convert them there
+            inputs = torch.tensor([input_ids], dtype=torch.int32)
+            if config.DEVICE == "cuda":
+                inputs = inputs.pin_memory().to(config.DEVICE, non_blocking=True)
+            inputs = inputs.long()
             n_input_tokens = inputs.shape[1]
         else:
             n_input_tokens = 0
 
-        if session_id is not None:
-            with storage_lock:
-                if session_id not in inference_sessions:
-                    raise KeyError(f"Session {repr(session_id)} expired or does not exist")
-                session, session_lock = inference_sessions.get(session_id).value
-                inference_sessions.store(
-                    session_id,
-                    (session, session_lock),
-                    hivemind.get_dht_time() + config.STEP_TIMEOUT,
-                )
+        # generate() treats pad tokens as padding, so empty prompts and prompts with them can't share a batch
+        # (otherwise, they would make generate() fail for the whole batch)
+        if session_id is None and n_input_tokens > 0 and tokenizer.pad_token_id not in input_ids:
+            # Stateless requests are merged with concurrent ones into a single batched generate() call
+            future = Future()
+            generate_queue.put((model_name, inputs, generate_kwargs, future))
+            outputs = tokenizer.decode(future.result())
         else:
-            session = None
-            session_lock = nullcontext()
-
-        with session_lock:
-            outputs = model.generate(
-                inputs=inputs,
-                do_sample=do_sample,
-                temperature=temperature,
-                top_k=top_k,
-                top_p=top_p,
-                max_length=max_length,
-                max_new_tokens=max_new_tokens,
-                session=session,
-            )
-        outputs = tokenizer.decode(outputs[0, n_input_tokens:])
+            if session_id is not None:
+                with inference_sessions.lock:
+                    if session_id not in inference_sessions:
+                        raise KeyError(f"Session {repr(session_id)} expired or does not exist")
+                    session, session_lock = inference_sessions.get(session_id)
+                    inference_sessions.store(
+                        session_id,
+                        (session, session_lock),
+                        hivemind.get_dht_time() + config.STEP_TIMEOUT,
+                    )
+            else:
+                session = None
+                session_lock = nullcontext()
+
+            with session_lock:
+                outputs = model.generate(inputs=inputs, **generate_kwargs, session=session)
+            outputs = tokenizer.decode(outputs[0, n_input_tokens:])
         logger.info(f"generate(), outputs={repr(outputs)}")
 
         return jsonify(ok=True, outputs=outputs)
@@ -116,6 +178,79 @@ def http_api_generate():
         return jsonify(ok=False, traceback=format_exc())
 
 
+def _generate_worker():
+    while True:
+        tasks = [generate_queue.get()]
+        deadline = time.monotonic() + config.BATCH_WAIT_TIME
+        while len(tasks) < config.MAX_BATCH_SIZE:
+            try:
+                tasks.append(generate_queue.get(timeout=max(deadline - time.monotonic(), 0)))
+            except Empty:
+                break
+
+        # We merge only prompts of the same length sent with the same generation parameters. With right padding,
+        # generate() would feed the rest of longer prompts one token per step (one swarm round-trip each)
+        # and open a longer inference session than any of these requests would need alone
+        batches = defaultdict(list)
+        for model_name, inputs, generate_kwargs, future in tasks:
+            key = model_name, inputs.shape[1], tuple(sorted(generate_kwargs.items()))
+            batches[key].append((inputs, future))
+
+        for (model_name, n_input_tokens, generate_kwargs), batch in batches.items():
+            try:
+                # Each batch runs in its own thread, so a long generation does not delay the others
+                threading.Thread(
+                    target=_generate_batch,
+                    args=(model_name, n_input_tokens, dict(generate_kwargs), batch),
+                    daemon=True,
+                ).start()
+            except Exception as e:
+                # Fail only this batch and keep serving the queue, otherwise all later requests would hang
+                logger.warning("Failed to start a generate() batch:", exc_info=True)
+                for _, future in batch:
+                    future.set_exception(e)
+
+
+def _generate_batch(model_name, n_input_tokens, generate_kwargs, batch):
+    try:
+        model, _ = models[model_name]
+        logger.info(f"generate(), model={repr(model_name)}, batch_size={len(batch)}")
+        outputs = model.generate(inputs=torch.cat([inputs for inputs, _ in batch]), **generate_kwargs)
+
+        # We copy all rows with a single transfer and let the requesting threads decode them in parallel,
+        # so that this thread finishes as soon as the remote generation is done
+        outputs = outputs[:, n_input_tokens:].cpu()
+        for row, (_, future) in zip(outputs, batch):
+            new_tokens = row.tolist()
+            # generate() stops only when all rows have finished, so we drop what this row got after its EOS
+            if model.config.eos_token_id in new_tokens:
+                new_tokens = new_tokens[:new_tokens.index(model.config.eos_token_id) + 1]
+            future.set_result(new_tokens)
+    except Exception as e:
+        for _, future in batch:
+            if not future.done():
+                future.set_exception(e)
+
+
+threading.Thread(target=_generate_worker, daemon=True).start()
+
+
+def tokenize(model_name, text):
+    # Chat clients often resend the same prompts (e.g., a system prompt), so we cache the token IDs.
+    # The cache is keyed by the prompts themselves, so we don't cache long ones to bound its memory usage
+    if len(text) <= config.MAX_CACHED_PROMPT_LENGTH:
+        return _tokenize_cached(model_name, text)
+    return _tokenize(model_name, text)
+
+
+def _tokenize(model_name, text):
+    _, tokenizer = models[model_name]
+    return tuple(tokenizer(text)["input_ids"])
+
+
+_tokenize_cached = lru_cache(maxsize=1024)(_tokenize)
+
+
 def get_typed_arg(name, expected_type, default=None):
     value = request.values.get(name)
     return expected_type(value) if value is not None else default